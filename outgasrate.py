@@ -1,47 +1,55 @@
 #! /usr/bin/env python3
 import numpy as np
-from scipy.optimize import leastsq
 import matplotlib.pyplot as plt
+from dateutil.tz import tzlocal
 from GL840.MongoDBHandler import MongoDBPuller
 import datetime
 from typing import Any, Callable
 from time import sleep
 import argparse
-import os
+import contextlib
+import shutil
+import subprocess
 from argparse import RawTextHelpFormatter, RawDescriptionHelpFormatter, ArgumentDefaultsHelpFormatter
 
 
-def calcchi(params, model_func, xvalues, yvalues, yerrors):
-    model = model_func(xvalues, yvalues, params)
-    chi = (yvalues - model) / yerrors
-    return (chi)
-
-
-def solve_leastsq(xvalues, yvalues, yerrors, param_init, model_func):
-    param_result, covar_output, _, _, _ = leastsq(
-        calcchi,
-        param_init,
-        args=(model_func, xvalues, yvalues, yerrors),
-        full_output=True)
-    error_result = np.sqrt(np.diag(covar_output))
-    dof = len(xvalues) - 1 - len(param_init)
-    chi2 = np.sum(np.power(calcchi(param_result, model_func, xvalues, yvalues, yerrors), 2.0))
+def solve_leastsq(xvalues, yvalues, yerrors):
+    # Closed-form weighted least squares for y = p0 * x + p1.
+    # x is shifted by its weighted mean so that large unixtime values do not
+    # cancel catastrophically in the normal equations.
+    if len(xvalues) < 2:
+        raise ValueError("At least two data points are needed to fit.")
+    weights = 1.0 / (yerrors * yerrors)
+    s = weights.sum()
+    x_mean = (weights * xvalues).sum() / s
+    y_mean = (weights * yvalues).sum() / s
+    dx = xvalues - x_mean
+    sxx = (weights * dx * dx).sum()
+    if sxx == 0.0:
+        raise ValueError("All x values are identical, so slope is undetermined.")
+    sxy = (weights * dx * yvalues).sum()
+    p0 = sxy / sxx
+    p1 = y_mean - p0 * x_mean
+    param_result = np.array([p0, p1])
+    error_result = np.sqrt(np.array([1.0 / sxx, 1.0 / s + x_mean * x_mean / sxx]))
+    dof = len(xvalues) - 1 - len(param_result)
+    residuals = (yvalues - y_mean - p0 * dx) / yerrors
+    chi2 = residuals @ residuals
     return ([param_result, error_result, chi2, dof])
 
 
-def mymodel(xvalues, yvalues, params):
-    assert type(xvalues) is np.ndarray, "xvalues must be numpy.ndarray"
-    p0, p1 = params
-    model_y = p0 * xvalues + p1
-    return model_y
+def conversionMPT200(data: Any) -> Any:
+    return np.power(10.0, 1.667 * np.asarray(data, dtype=float) - 9.333)
 
 
-def conversionMPT200(data: Any) -> Any:
-    return 10**(1.667 * data - 9.333)
+_puller_cache: dict[tuple[str, Any], MongoDBPuller] = {}
 
 
 def fetchData(data_name: str, func: Callable = lambda x: x, ip: str = "192.168.160.22", port=None) -> None | tuple[float | int, float]:
-    puller = MongoDBPuller(ip, port)
+    puller = _puller_cache.get((ip, port))
+    if puller is None:
+        puller = MongoDBPuller(ip, port)
+        _puller_cache[(ip, port)] = puller
     data = puller.pull_one("GL840", "GL840")
     if data is None:
         return None
@@ -99,33 +107,59 @@ def MPT200Error(value: float) -> float:
         raise ValueError("Pressure value is incorrect, so cant estimate error.")
 
 
+def MPT200Error_vec(values: np.ndarray) -> np.ndarray:
+    '''
+    MPT200Error_vec
+    -
+
+    Vectorized version of MPT200Error
+
+    Parameters
+    --
+
+    values: numpy.ndarray
+        Measurement values of MPT200
+
+
+    Returns
+    --
+
+    Errors: numpy.ndarray
+        Errors of MPT200 (Half width)
+
+    '''
+    values = np.asarray(values, dtype=float)
+    errors = np.select([(values > 1000.0) & (values < 100000.0),
+                        (values < 1000.0) & (values > 2e-3),
+                        (values < 2e-3) & (values > 1e-8)],
+                       [values * 0.3, values * 0.1, values * 0.25],
+                       default=np.nan)
+    if np.isnan(errors).any():
+        raise ValueError("Pressure value is incorrect, so cant estimate error.")
+    return errors
+
+
 class MyHelper(RawTextHelpFormatter, RawDescriptionHelpFormatter, ArgumentDefaultsHelpFormatter):
     pass
 
 
 def read_file(filename, use_auto_error, error_fix=0, start_pressure=None):
-    with open(filename, "r") as f:
-        print(f"CSV file read: {filename}")
-        lines = f.readlines()
-        times = []
-        datas = []
-        errors = []
-        for line in lines[1:]:
-            time, data = line.strip().split(",")
-            if (start_pressure is not None and float(data) < start_pressure):
-                continue
-            times.append(float(time))
-            datas.append(float(data))
-            err = error_fix
-            if (use_auto_error):
-                err = MPT200Error(float(data))
-            errors.append(err)
+    print(f"CSV file read: {filename}")
+    times, datas = np.loadtxt(filename, delimiter=",", skiprows=1, usecols=(0, 1), ndmin=2, unpack=True)
+    if (start_pressure is not None):
+        mask = datas >= start_pressure
+        times = times[mask]
+        datas = datas[mask]
+    if (use_auto_error):
+        errors = MPT200Error_vec(datas)
+    else:
+        errors = np.full(len(datas), error_fix, dtype=float)
     return times, datas, errors
 
 
-def fit_linear(times_arr, datas_arr, errors_arr, init_params=np.array([0, 100])):
+def fit_linear(times_arr, datas_arr, errors_arr):
     try:
-        res = solve_leastsq(times_arr, datas_arr, errors_arr, init_params, mymodel)
+        res = solve_leastsq(times_arr, datas_arr, errors_arr)
     except Exception as e:
         print(f"Fit Error: {e}")
         raise e
@@ -175,86 +209,76 @@ if __name__ == "__main__":
             raise ValueError("Start pressure must be positive.")
     if (namespace.read is not None):
         print("Read mode")
-        read_file(namespace.read, use_auto_error, namespace.error, namespace.start_pressure)
+        times_arr, datas_arr, errors_arr = read_file(namespace.read, use_auto_error, namespace.error, namespace.start_pressure)
     else:
         timekeeper = TimeKeeper(datetime.timedelta(0, namespace.duration))
         timekeeper.start()
-        times = []
-        errors = []
-        datas = []
-        while (not timekeeper.check()):
-            try:
-                tup = fetchData(namespace.dataname, conversionMPT200, ip="192.168.1.30")
-                if tup is None:
-                    print("Data is None. Retry after 2.0s")
-                    sleep(2.0)
-                    continue
-                if (namespace.start_pressure is not None and tup[1] < namespace.start_pressure):
-                    print(f"Pressure ({tup[1]:0.3e} Pa) is lower than start pressure.")
-                    sleep(2.0)
-                    continue
-                if len(times) == 0:
-                    print("---------------Out Gas Rate Measurement Start!!---------------")
-                    timekeeper.print_starttime()
-                    with open(namespace.filename + ".csv", "w") as f:
-                        print(f"Time,{namespace.dataname}", file=f)
+        capacity = int(namespace.duration / 2.0) + 16
+        times = np.empty(capacity)
+        datas = np.empty(capacity)
+        n = 0
+        with contextlib.ExitStack() as stack:
+            csv_file = None
+            while (not timekeeper.check()):
+                try:
+                    tup = fetchData(namespace.dataname, conversionMPT200, ip="192.168.1.30")
+                    if tup is None:
+                        print("Data is None. Retry after 2.0s")
+                        sleep(2.0)
+                        continue
+                    time, data = tup
+                    if (namespace.start_pressure is not None and data < namespace.start_pressure):
+                        print(f"Pressure ({data:0.3e} Pa) is lower than start pressure.")
+                        sleep(2.0)
+                        continue
+                    if n == 0:
+                        print("---------------Out Gas Rate Measurement Start!!---------------")
+                        timekeeper.print_starttime()
+                        csv_file = stack.enter_context(open(namespace.filename + ".csv", "w"))
+                        csv_file.write(f"Time,{namespace.dataname}\n")
                         print(f"CSV file created: {namespace.filename}.csv")
-                time = tup[0]
-                data = tup[1]
-                print(f"Time:{datetime.datetime.fromtimestamp(time).strftime("%Y/%m/%d %H:%M:%S")} data:{data:0.3e}")
-                with open(namespace.filename + ".csv", "a") as f:
-                    print(f"{time},{data}", file=f)
-                times.append(time)
-                datas.append(data)
-                err = namespace.error
-                if (use_auto_error):
-                    err = MPT200Error(float(data))
-                errors.append(err)
-                sleep(2.0)
-            except KeyboardInterrupt:
-                length_min = min(len(times), len(datas), len(errors))
-                if (len(datas) != length_min):
-                    print("Some data were removed")
-                    sz = len(datas)
-                    for i in range(sz - length_min):
-                        datas.pop()
-                if (len(times) != length_min):
-                    print("Some time data were removed")
-                    sz = len(times)
-                    for i in range(sz - length_min):
-                        times.pop()
-                if (len(errors) != length_min):
-                    print("Some error data were removed")
-                    sz = len(errors)
-                    for i in range(sz - length_min):
-                        errors.pop()
-                break
+                    print(f"Time:{datetime.datetime.fromtimestamp(time).strftime("%Y/%m/%d %H:%M:%S")} data:{data:0.3e}")
+                    csv_file.write(f"{time},{data}\n")
+                    if n == capacity:
+                        capacity *= 2
+                        times = np.resize(times, capacity)
+                        datas = np.resize(datas, capacity)
+                    # n is advanced only after both writes, so an interrupt never leaves a half-written sample.
+                    times[n] = time
+                    datas[n] = data
+                    n += 1
+                    sleep(2.0)
+                except KeyboardInterrupt:
+                    break
 
         print("----------------------Stop Measurement!!----------------------")
-    times_arr = np.array(times)
-    datas_arr = np.array(datas)
-    errors_arr = np.array(errors)
-    init_params = np.array([0, 100])
+        times_arr = times[:n]
+        datas_arr = datas[:n]
+        if (use_auto_error):
+            errors_arr = MPT200Error_vec(datas_arr)
+        else:
+            errors_arr = np.full(len(datas_arr), namespace.error, dtype=float)
     fit_success = True
     try:
-        a, a_error, b, b_error = fit_linear(times_arr, datas_arr, errors_arr, init_params)
+        a, a_error, b, b_error = fit_linear(times_arr, datas_arr, errors_arr)
     except Exception as e:
         print(f"Fit Error: {e}")
         fit_success = False
     stoh = 3600
-    time_datetime = [datetime.datetime.fromtimestamp(x) for x in times_arr]
+    time_datetime = (times_arr * 1e3).astype("datetime64[ms]")
     fig = plt.figure()
     ax = fig.add_subplot(111)
+    # datetime64 values are UTC; tzlocal applies the local offset (DST included) at each tick.
+    ax.xaxis_date(tz=tzlocal())
     if fit_success:
         ax.plot(time_datetime, a * times_arr + b, "-", color="r", label="slope : {:.4} ± {:.2} Pa/h".format(a * stoh, a_error * stoh), )
         ax.legend()
-    skip_num = 1
-    sz_time = len(times)
-    if (namespace.display_number == 0):
-        skip_num = 1
-    elif (sz_time > namespace.display_number):
-        skip_num = len(times_arr) // namespace.display_number
-    ax.errorbar(time_datetime[::skip_num], datas_arr[::skip_num], yerr=errors_arr[::skip_num], fmt="o", capsize=10, markersize=6, ecolor='black', markeredgecolor="black", color='w')
+    sz_time = len(times_arr)
+    if (namespace.display_number != 0 and sz_time > namespace.display_number):
+        idx = np.linspace(0, sz_time - 1, namespace.display_number).astype(np.intp)
+    else:
+        idx = np.arange(sz_time)
+    ax.errorbar(time_datetime[idx], datas_arr[idx], yerr=errors_arr[idx], fmt="o", capsize=10, markersize=6, ecolor='black', markeredgecolor="black", color='w')
     ax.set_xlabel("time [s]")
     ax.set_ylabel("inner pressure [Pa]")
     fig.autofmt_xdate()
@@ -264,6 +288,8 @@ if __name__ == "__main__":
         print(f"Saved image to {save_path}")
     if fit_success:
         print(f"\nResult: Outgas Rate = {a * stoh:.4} ± {a_error * stoh:.2} Pa/h")
-    os.system('afplay /System/Library/Sounds/Ping.aiff')
+    afplay = shutil.which("afplay")
+    if afplay is not None:
+        subprocess.Popen([afplay, "/System/Library/Sounds/Ping.aiff"])
     if (namespace.show):
         plt.show()
@@ -1,12 +1,13 @@
 #! /usr/bin/env python3
 
-import numpy as np
 import matplotlib.pyplot as plt
 import argparse
 from argparse import RawTextHelpFormatter, RawDescriptionHelpFormatter, ArgumentDefaultsHelpFormatter
 import datetime
-import glob
+import os
 import re
+import multiprocessing
+import itertools
 from outgasrate import fit_linear, read_file
 
 DATE_FORMAT = "%Y%m%d%H%M%S"
@@ -25,20 +26,34 @@ def parse_argument():
     return namespace
 
 
-def select_file(filelist, prefix, start_time, end_time):
+def select_file(prefix, start_time, end_time):
     file_to_read = []
-    re_pattern = prefix + "(\\d*)\\.csv"
-    reg = re.compile(re_pattern)
-    for file in filelist:
-        res = re.fullmatch(reg, file)
-        if (res is not None):
-            time = datetime.datetime.strptime(res[1], DATE_FORMAT)
-            if (time < end_time) and (time > start_time):
-                file_to_read.append((time, file))
-    file_to_read.sort(key=lambda x: x[1])
+    dirname, basename = os.path.split(prefix)
+    reg = re.compile(r"(\d+)\.csv")
+    with os.scandir(dirname or ".") as entries:
+        for entry in entries:
+            if not entry.name.startswith(basename):
+                continue
+            res = reg.fullmatch(entry.name, len(basename))
+            if (res is not None):
+                time = datetime.datetime.strptime(res[1], DATE_FORMAT)
+                if (time < end_time) and (time > start_time):
+                    file_to_read.append((time, os.path.join(dirname, entry.name)))
+    file_to_read.sort(key=lambda x: x[0])
     return file_to_read
 
 
+def _process(file, start_pressure):
+    times_arr, datas_arr, errors_arr = read_file(file[1], True, start_pressure=start_pressure)
+    try:
+        a, a_error, _, _ = fit_linear(times_arr, datas_arr, errors_arr)
+    except Exception as e:
+        print(f"Failed to fit data in {file[1]}")
+        print(e)
+        return None
+    return file[0], a, a_error
+
+
 def main():
     namespace = parse_argument()
     try:
@@ -58,25 +73,22 @@ def main():
         print(f"Start pressure: {namespace.start_pressure:0.3e} Pa")
         if (namespace.start_pressure < 0):
             raise ValueError("Start pressure must be positive.")
-    path = namespace.prefix + "*.csv"
-    filelist = glob.glob(path)
-    file_to_read = select_file(filelist, namespace.prefix, start_time, end_time)
+    file_to_read = select_file(namespace.prefix, start_time, end_time)
     x = []
     y = []
     err = []
     stoh = 3600
-    for file in file_to_read:
-        times, datas, errors = read_file(file[1], True, start_pressure=namespace.start_pressure)
-        times_arr = np.array(times)
-        datas_arr = np.array(datas)
-        errors_arr = np.array(errors)
-        try:
-            a, a_error, b, b_error = fit_linear(times_arr, datas_arr, errors_arr)
-        except Exception as e:
-            print(f"Failed to fit data in {file[1]}")
-            print(e)
+    args = [(file, namespace.start_pressure) for file in file_to_read]
+    if len(file_to_read) < 2:
+        results = list(itertools.starmap(_process, args))
+    else:
+        with multiprocessing.Pool(min(len(file_to_read), os.cpu_count() or 1)) as pool:
+            results = pool.starmap(_process, args)
+    for result in results:
+        if result is None:
             continue
-        x.append(file[0])
+        time, a, a_error = result
+        x.append(time)
         y.append(a * stoh)
         err.append(a_error * stoh)
     fig = plt.figure()